@@ -1,18 +1,52 @@
 import io
+import os
 import zipfile
+from contextlib import suppress
 from pathlib import Path
 import streamlit as st
-from PIL import Image
-from rembg import remove
+from PIL import Image, ImageOps
+from rembg.sessions import sessions_class
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 import numpy as np
+import onnxruntime as ort
 
 MAX_FILES = 10  # Increased limit with better performance
 ALLOWED_TYPES = ["png", "jpg", "jpeg", "webp"]
 MAX_IMAGE_SIZE_MB = 10
 MB_TO_BYTES = 1024 * 1024
+# Bounds decode cost for decompression bombs; checked from the header before decoding
+MAX_IMAGE_PIXELS = 50_000_000
+# zlib level for PNG output; optimize=True costs several extra passes for little gain
+PNG_COMPRESS_LEVEL = 6
+# Previews kept in session state; full-resolution images only live on as encoded bytes
+THUMBNAIL_SIZE = (800, 800)
+THUMBNAIL_JPEG_QUALITY = 80
+MODEL_OPTIONS = {
+    "Fast (u2netp)": "u2netp",
+    "Balanced (u2net)": "u2net",
+    "Best Quality (isnet-general-use)": "isnet-general-use",
+}
+DEFAULT_MODEL = "u2netp"
+# Models sharing U²-Net pre-processing, so a converted copy can run as "u2net_custom"
+U2NET_MODELS = {"u2netp", "u2net"}
+# Execution providers in order of preference; CPU is always the last resort
+PREFERRED_PROVIDERS = (
+    "CUDAExecutionProvider",
+    "CoreMLExecutionProvider",
+    "DmlExecutionProvider",
+    "CPUExecutionProvider",
+)
+CPU_PROVIDER = "CPUExecutionProvider"
+# rembg pre-processing per model: (mean, std, model input size)
+MODEL_NORMALIZATION = {
+    "u2netp": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2net": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "isnet-general-use": ((0.5, 0.5, 0.5), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+# Rows per Run; bounds activation memory (notably isnet at 1024²) and paces progress
+INFERENCE_BATCH_SIZE = 4
 
 def setup_page():
     """Sets up the Streamlit page configuration."""
@@ -71,6 +105,117 @@ def hide_streamlit_style():
     </style>
     """, unsafe_allow_html=True)
 
+@st.cache_resource(show_spinner="Loading background removal model...")
+def get_session(model_name=DEFAULT_MODEL, use_gpu=False):
+    """Creates the rembg session once and shares it across reruns and threads."""
+    providers = get_providers(use_gpu)
+    if providers[0] == CPU_PROVIDER and model_name in U2NET_MODELS:
+        model_path = get_optimized_model_path(Path(get_session_class(model_name).download_models()))
+        if model_path is not None:
+            # The serving session always gets ORT_ENABLE_ALL; the hardware-specific layout
+            # passes run at load on top of the portable fusions already in the file
+            try:
+                session_class = get_session_class("u2net_custom")
+                return session_class(
+                    "u2net_custom", get_session_options(), providers=providers, model_path=str(model_path)
+                )
+            except Exception:
+                # Unreadable cached graph; drop it so the next launch rebuilds it
+                with suppress(OSError):
+                    model_path.unlink()
+    
+    # Accelerators get FP16 weights when the optional converter is installed
+    if providers[0] != CPU_PROVIDER and model_name in U2NET_MODELS:
+        model_path = get_fp16_model_path(model_name)
+        if model_path is not None:
+            try:
+                session_class = get_session_class("u2net_custom")
+                session = session_class(
+                    "u2net_custom", get_session_options(), providers=providers, model_path=str(model_path)
+                )
+                # ORT can list CUDA without its libraries and quietly fall back to CPU,
+                # where the FP16 graph only runs through inserted casts
+                if session.inner_session.get_providers()[0] != CPU_PROVIDER:
+                    return session
+            except Exception:
+                # Accelerator or FP16 graph failed to initialise; use the FP32 weights below
+                pass
+    
+    # rembg's new_session() builds its own SessionOptions, so construct the class directly
+    return get_session_class(model_name)(model_name, get_session_options(), providers=providers)
+
+def get_optimized_model_path(model_path):
+    """Saves a portable optimized copy of the model once, or returns None if it can't."""
+    # Saved graphs only carry portable (EXTENDED) fusions and are keyed by ORT version
+    optimized_path = model_path.with_name(f"{model_path.stem}.ort{ort.__version__}.opt.onnx")
+    if not optimized_path.exists():
+        tmp_path = get_temp_path(optimized_path)
+        try:
+            sess_opts = get_session_options(ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED)
+            sess_opts.optimized_model_filepath = str(tmp_path)
+            # Throwaway session: it only exists to write the graph, not to serve requests
+            ort.InferenceSession(str(model_path), sess_options=sess_opts, providers=[CPU_PROVIDER])
+            os.replace(tmp_path, optimized_path)
+        except Exception:
+            # Read-only model dir or failed save; the stock model still works
+            with suppress(OSError):
+                tmp_path.unlink()
+            return None
+    return optimized_path
+
+def get_temp_path(path):
+    """Returns a unique sibling path to write to before moving a file into place."""
+    return path.with_name(f"{path.stem}.{uuid.uuid4().hex}.tmp{path.suffix}")
+
+def get_session_class(model_name):
+    """Looks up the rembg session class registered under a model name."""
+    return next(cls for cls in sessions_class if cls.name() == model_name)
+
+def get_session_options(optimization_level=ort.GraphOptimizationLevel.ORT_ENABLE_ALL):
+    """Returns ONNX Runtime options tuned for one shared CPU/GPU inference session."""
+    sess_opts = ort.SessionOptions()
+    sess_opts.graph_optimization_level = optimization_level
+    sess_opts.enable_cpu_mem_arena = True
+    sess_opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    sess_opts.intra_op_num_threads = os.cpu_count() or 1
+    return sess_opts
+
+def get_providers(use_gpu=True):
+    """Returns the available execution providers, best accelerator first."""
+    if not use_gpu:
+        return [CPU_PROVIDER]
+    available = ort.get_available_providers()
+    return [p for p in PREFERRED_PROVIDERS if p in available]
+
+def has_gpu_provider():
+    """Checks whether ONNX Runtime exposes any accelerator besides the CPU."""
+    return get_providers(use_gpu=True)[0] != CPU_PROVIDER
+
+def get_fp16_model_path(model_name):
+    """Converts the downloaded model to FP16 once, or returns None if that isn't possible."""
+    try:
+        import onnx
+        from onnxconverter_common import float16
+    except ImportError:
+        return None
+    
+    model_fp32 = Path(get_session_class(model_name).download_models())
+    model_fp16 = model_fp32.with_name(f"{model_fp32.stem}_fp16.onnx")
+    
+    if not model_fp16.exists():
+        tmp_path = get_temp_path(model_fp16)
+        try:
+            # Keep float32 inputs/outputs so the NumPy pre/post-processing is unchanged
+            model = float16.convert_float_to_float16(onnx.load(str(model_fp32)), keep_io_types=True)
+            onnx.save(model, str(tmp_path))
+            os.replace(tmp_path, model_fp16)
+        except Exception:
+            # Conversion failed or the model dir is read-only; the FP32 weights still run
+            with suppress(OSError):
+                tmp_path.unlink()
+            return None
+    return model_fp16
+
 def initialize_session():
     """Initializes session variables."""
     if "uploader_key" not in st.session_state:
@@ -85,6 +230,22 @@ def display_sidebar():
     with st.sidebar:
         st.markdown("## ⚙️ Settings")
         
+        quality = st.selectbox(
+            "Quality vs Speed",
+            list(MODEL_OPTIONS),
+            index=0,
+            help="Smaller models run faster at the cost of some edge detail"
+        )
+        model_name = MODEL_OPTIONS[quality]
+        
+        gpu_available = has_gpu_provider()
+        use_gpu = st.toggle(
+            "Use GPU acceleration",
+            value=gpu_available,
+            disabled=not gpu_available,
+            help="Runs the model on CUDA, CoreML or DirectML when available"
+        )
+        
         # Background options
         bg_option = st.radio(
             "Background Options",
@@ -130,7 +291,7 @@ def display_sidebar():
         st.markdown("---")
         display_footer()
         
-        return uploaded_files, bg_option, bg_color, bg_image, process_btn
+        return uploaded_files, bg_option, bg_color, bg_image, model_name, use_gpu, process_btn
 
 def display_footer():
     """Displays a custom footer."""
@@ -141,8 +302,8 @@ def display_footer():
     """
     st.sidebar.markdown(footer, unsafe_allow_html=True)
 
-def process_images_parallel(uploaded_files, bg_option, bg_color, bg_image):
-    """Processes images in parallel using ThreadPoolExecutor."""
+def process_images_parallel(uploaded_files, bg_option, bg_color, bg_image, model_name=DEFAULT_MODEL, use_gpu=False):
+    """Decodes and composites images in parallel around batched model runs."""
     st.session_state.processing = True
     st.session_state.results = []
     
@@ -150,50 +311,183 @@ def process_images_parallel(uploaded_files, bg_option, bg_color, bg_image):
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    def process_single_image(file):
+    # Resolve the shared session on the script thread; workers only call Run on it
+    try:
+        session = get_session(model_name, use_gpu)
+    except Exception as e:
+        # Model download or conversion failed; leave the app ready for another try
+        st.error(f"Could not load the background removal model: {str(e)}")
+        st.session_state.processing = False
+        progress_bar.empty()
+        status_text.empty()
+        return
+    
+    # Reject oversized files by their reported size before reading them into memory,
+    # then read the rest here so workers only ever see plain bytes
+    uploads = []
+    for file in uploaded_files:
+        if file.size > MAX_IMAGE_SIZE_MB * MB_TO_BYTES:
+            st.warning(f"Image {file.name} exceeds {MAX_IMAGE_SIZE_MB}MB limit")
+        else:
+            uploads.append((file.name, file.getvalue()))
+    
+    # PIL and NumPy release the GIL in their C loops, so threads scale with cores
+    max_workers = max(1, min(os.cpu_count() or 1, len(uploads)))
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # PIL decode/encode runs on the pool, inference runs batched on this thread
+        loaded = []
+        load_futures = [executor.submit(load_image, name, data) for name, data in uploads]
+        for future in load_futures:
+            original, data, name = future.result()
+            if original:
+                loaded.append((original, data, name))
+            else:
+                st.warning(data)  # Display warning message
+        
+        # Inference is the slow stage, so it covers the first half of the progress bar
+        total_steps = 2 * len(loaded)
+        
+        def report_inference(done):
+            progress_bar.progress(done / total_steps)
+            status_text.text(f"Removed backgrounds from {done}/{len(loaded)} images")
+        
+        status_text.text(f"Removing backgrounds from {len(loaded)} images...")
         try:
-            if len(file.getvalue()) > MAX_IMAGE_SIZE_MB * MB_TO_BYTES:
-                return None, f"Image {file.name} exceeds {MAX_IMAGE_SIZE_MB}MB limit", None
-            
-            original = Image.open(file).convert("RGBA")
-            result = remove_background(file.getvalue())
-            
-            if bg_option == "Color":
-                result = add_color_background(result, bg_color)
-            elif bg_option == "Image" and bg_image:
-                result = add_image_background(result, bg_image)
-                
-            return original, result, file.name
+            masks = predict_masks(
+                session, model_name, [original for original, _, _ in loaded], report_inference
+            )
         except Exception as e:
-            return None, f"Error processing {file.name}: {str(e)}", None
-    
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_single_image, file) for file in uploaded_files]
+            st.error(f"Unexpected error: {str(e)}")
+            loaded, masks = [], []
+        
+        # Resize the background once per distinct foreground size, not once per image
+        backgrounds = {}
+        if bg_option == "Image" and bg_image:
+            backgrounds = {
+                size: (bg_image.resize(size) if bg_image.size != size else bg_image).convert("RGBA")
+                for size in {original.size for original, _, _ in loaded}
+            }
+        
+        # Map each future to its upload position so results keep the upload order
+        futures = {
+            executor.submit(
+                process_single_image, original, data, mask, name,
+                bg_option, bg_color, backgrounds.get(original.size)
+            ): index
+            for index, ((original, data, name), mask) in enumerate(zip(loaded, masks))
+        }
         
-        for i, future in enumerate(futures):
+        # Handle images as they finish so a slow one doesn't stall the progress bar
+        finished = []
+        for i, future in enumerate(as_completed(futures)):
             try:
-                original, result, name = future.result()
-                if original and result:
-                    st.session_state.results.append((original, result, name))
+                thumb, result_thumb, name, original_bytes, result_bytes = future.result()
+                if thumb and result_thumb:
+                    finished.append(
+                        (futures[future], (thumb, result_thumb, name, original_bytes, result_bytes))
+                    )
                 elif name:
-                    st.warning(result)  # Display warning message
+                    st.warning(result_thumb)  # Display warning message
             except Exception as e:
                 st.error(f"Unexpected error: {str(e)}")
             
             # Update progress
-            progress = (i + 1) / len(futures)
+            progress = (len(futures) + i + 1) / (2 * len(futures))
             progress_bar.progress(progress)
-            status_text.text(f"Processed {i + 1}/{len(uploaded_files)} images")
+            status_text.text(f"Processed {i + 1}/{len(futures)} images")
+        
+        st.session_state.results = [entry for _, entry in sorted(finished, key=lambda item: item[0])]
     
     processing_time = time.time() - start_time
     status_text.text(f"Completed in {processing_time:.2f} seconds!")
     st.session_state.processing = False
     progress_bar.empty()
 
-def remove_background(image_bytes):
-    """Removes the background from an image."""
-    result = remove(image_bytes)
-    return Image.open(io.BytesIO(result)).convert("RGBA")
+def load_image(name, data):
+    """Decodes uploaded image bytes into an RGBA image."""
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            return None, f"Image {name} exceeds {MAX_IMAGE_PIXELS // 1_000_000} megapixels", name
+        
+        # Apply the EXIF orientation as rembg.remove did, since downloads drop the tag
+        return ImageOps.exif_transpose(image).convert("RGBA"), data, name
+    except Exception as e:
+        return None, f"Error processing {name}: {str(e)}", name
+
+def process_single_image(original, data, mask, name, bg_option, bg_color, bg_image):
+    """Cuts out one image, applies the chosen background and encodes the result."""
+    # Encode the result once here so reruns reuse the bytes for downloads, and keep
+    # only thumbnails of the full-resolution images for display
+    try:
+        result = apply_mask(original, mask)
+        
+        if bg_option == "Color":
+            result = add_color_background(result, bg_color)
+        elif bg_option == "Image" and bg_image:
+            result = add_image_background(result, bg_image)
+            
+        return make_thumbnail(original), make_thumbnail(result), name, data, image_to_bytes(result)
+    except Exception as e:
+        return None, f"Error processing {name}: {str(e)}", name, None, None
+
+def make_thumbnail(image):
+    """Returns a downscaled preview of an image, pre-encoded for st.image."""
+    thumb = image.copy()
+    thumb.thumbnail(THUMBNAIL_SIZE, Image.Resampling.BILINEAR)
+    
+    buf = io.BytesIO()
+    # Opaque previews go out as JPEG; only real transparency needs PNG
+    if thumb.mode == "RGBA" and thumb.getchannel("A").getextrema() != (255, 255):
+        thumb.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    else:
+        thumb.convert("RGB").save(buf, format="JPEG", quality=THUMBNAIL_JPEG_QUALITY)
+    return buf.getvalue()
+
+def predict_masks(session, model_name, images, on_progress=None):
+    """Runs the model over batches of images and returns one L-mode mask per image."""
+    if not images:
+        return []
+    
+    model_input = session.inner_session.get_inputs()[0]
+    # Models exported with a fixed batch of one are run row by row
+    batch_size = 1 if model_input.shape[0] == 1 else INFERENCE_BATCH_SIZE
+    
+    mean, std, size = MODEL_NORMALIZATION[model_name]
+    batch = np.empty((len(images), 3, size[1], size[0]), dtype=np.float32)
+    for i, image in enumerate(images):
+        batch[i] = preprocess_image(image, mean, std, size)
+    
+    # The last chunk is shorter rather than padded, so no Run does work on filler rows
+    preds = []
+    for start in range(0, len(images), batch_size):
+        preds.append(session.inner_session.run(None, {model_input.name: batch[start:start + batch_size]})[0])
+        if on_progress:
+            on_progress(min(start + batch_size, len(images)))
+    preds = np.concatenate(preds)
+    
+    return [postprocess_mask(pred[0], image.size) for pred, image in zip(preds, images)]
+
+def preprocess_image(image, mean, std, size):
+    """Resizes and normalizes an image into a (3, H, W) float32 model input."""
+    im = image.convert("RGB").resize(size, Image.Resampling.LANCZOS)
+    arr = np.asarray(im, dtype=np.float32)
+    arr /= max(float(arr.max()), 1.0)
+    arr = (arr - np.array(mean, dtype=np.float32)) / np.array(std, dtype=np.float32)
+    return arr.transpose(2, 0, 1)
+
+def postprocess_mask(pred, size):
+    """Scales a raw model prediction to 0-255 and resizes it back to the image size."""
+    ma, mi = pred.max(), pred.min()
+    pred = (pred - mi) / max(float(ma - mi), 1e-6)
+    mask = Image.fromarray((pred * 255).astype(np.uint8), mode="L")
+    return mask.resize(size, Image.Resampling.LANCZOS)
+
+def apply_mask(image, mask):
+    """Cuts out the foreground the same way rembg's naive cutout does."""
+    empty = Image.new("RGBA", image.size, 0)
+    return Image.composite(image, empty, mask)
 
 def add_color_background(image, color):
     """Adds a solid color background to a transparent image."""
@@ -209,8 +503,10 @@ def add_image_background(foreground, background_img):
     if background_img.size != foreground.size:
         background_img = background_img.resize(foreground.size)
     
-    background = background_img.convert('RGBA')
-    return Image.alpha_composite(background, foreground)
+    if background_img.mode != 'RGBA':
+        background_img = background_img.convert('RGBA')
+    
+    return Image.alpha_composite(background_img, foreground)
 
 def display_results():
     """Displays the processing results."""
@@ -223,10 +519,10 @@ def display_results():
     cols_per_row = 2
     for i in range(0, len(st.session_state.results), cols_per_row):
         cols = st.columns(cols_per_row)
-        for col, (original, result, name) in zip(cols, st.session_state.results[i:i+cols_per_row]):
+        for col, (thumb, result_thumb, name, _, _) in zip(cols, st.session_state.results[i:i+cols_per_row]):
             with col:
-                st.image(original, caption=f"Original: {name}", use_container_width=True)
-                st.image(result, caption=f"Result: {name}", use_container_width=True)
+                st.image(thumb, caption=f"Original: {name}", use_container_width=True)
+                st.image(result_thumb, caption=f"Result: {name}", use_container_width=True)
     
     # Download options
     st.markdown("---")
@@ -239,13 +535,13 @@ def display_results():
 
 def download_single_image(image_data):
     """Provides download button for a single image."""
-    original, result, name = image_data
+    _, _, name, original_bytes, result_bytes = image_data
     col1, col2 = st.columns(2)
     
     with col1:
         st.download_button(
             label="Download Original",
-            data=image_to_bytes(original),
+            data=original_bytes,
             file_name=f"original_{name}",
             mime=f"image/{Path(name).suffix[1:]}",
         )
@@ -253,7 +549,7 @@ def download_single_image(image_data):
     with col2:
         st.download_button(
             label="Download Result",
-            data=image_to_bytes(result),
+            data=result_bytes,
             file_name=f"{Path(name).stem}_nobg.png",
             mime="image/png",
         )
@@ -263,19 +559,15 @@ def download_all_images():
     if st.button("Download All as ZIP"):
         zip_buffer = io.BytesIO()
         
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for original, result, name in st.session_state.results:
-                # Add original
-                orig_bytes = image_to_bytes(original)
-                zip_file.writestr(f"originals/{name}", orig_bytes)
-                
-                # Add result
-                res_bytes = image_to_bytes(result)
-                zip_file.writestr(f"results/{Path(name).stem}_nobg.png", res_bytes)
+        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zip_file:
+            for _, _, name, original_bytes, result_bytes in st.session_state.results:
+                # Entries reuse the bytes encoded during processing; PNG is already deflated
+                zip_file.writestr(f"originals/{name}", original_bytes)
+                zip_file.writestr(f"results/{Path(name).stem}_nobg.png", result_bytes)
         
         st.download_button(
             label="Click to download ZIP",
-            data=zip_buffer.getvalue(),
+            data=zip_buffer,
             file_name="background_removed_images.zip",
             mime="application/zip",
         )
@@ -285,7 +577,7 @@ def image_to_bytes(img):
     buf = io.BytesIO()
     
     if img.mode == 'RGBA':
-        img.save(buf, format="PNG", optimize=True)
+        img.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
     else:
         img.save(buf, format="JPEG", quality=85, optimize=True)
     
@@ -294,10 +586,10 @@ def image_to_bytes(img):
 def main():
     setup_page()
     initialize_session()
-    uploaded_files, bg_option, bg_color, bg_image, process_btn = display_sidebar()
+    uploaded_files, bg_option, bg_color, bg_image, model_name, use_gpu, process_btn = display_sidebar()
     
     if process_btn and uploaded_files:
-        process_images_parallel(uploaded_files, bg_option, bg_color, bg_image)
+        process_images_parallel(uploaded_files, bg_option, bg_color, bg_image, model_name, use_gpu)
     
     display_results()
 